@@ -1,10 +1,16 @@
-from collections.abc import Callable, Iterable
-import functools
-from typing import Literal
+from collections import deque
+from collections.abc import Iterable
+import ctypes
+import os
+import select
+import struct
+import threading
+import time
+from typing import Final, Literal
 
 import uinput  # type: ignore
 import evdev  # type: ignore
-from evdev import KeyEvent, ecodes
+from evdev import ecodes
 
 type InKey = int
 type OutEvent = tuple[int, int]
@@ -12,90 +18,151 @@ type OutEventValue = int
 
 # Values for pressed and released.
 # Also used for the analog shoulder triggers
-BTN_DOWN_VAL: OutEventValue = 1
-BTN_UP_VAL: OutEventValue = 0
+BTN_DOWN_VAL: Final[OutEventValue] = 1
+BTN_UP_VAL: Final[OutEventValue] = 0
 
 # Thumbpad values along one axis. neutral is no
 # deflection, the others are full deflection,
 # with direction depending on event
-THUMB_MAX_VAL: OutEventValue = 255
-THUMB_MIN_VAL: OutEventValue = 0
-THUMB_NEUTRAL_VAL: OutEventValue = 128
+THUMB_MAX_VAL: Final[OutEventValue] = 255
+THUMB_MIN_VAL: Final[OutEventValue] = 0
+THUMB_NEUTRAL_VAL: Final[OutEventValue] = 128
 
 
-type InKeyAction = Callable[[bool], None]
-type InKeyListener = tuple[InKey, InKeyAction]
+# Print every emitted event. Formatting and writing these to the terminal
+# costs far more than the uinput write itself, so it is opt-in.
+DEBUG: Final = os.environ.get("CONTROLLER_DEBUG") == "1"
 
+# Grab the input device so that its key presses only reach this script
+# and not the rest of the system. Off by default, so the keyboard can still
+# be used normally.
+GRAB: Final = os.environ.get("CONTROLLER_GRAB") == "1"
 
-def build_keybinds(out_device: uinput.Device) -> Iterable[InKeyListener]:
-    def emit(event: OutEvent, value: OutEventValue) -> None:
-        print(f"{event=}, {value=}")
-        out_device.emit(event, value)
-
-    def direction_keys_to_axis(
-        *,
-        lo_on: InKey,
-        hi_on: InKey,
-        send: OutEvent,
-    ) -> Iterable[InKeyListener]:
-        lo_hi_state = [False, False]
-
-        def on_change(idx: Literal[0, 1], value: bool) -> None:
-            lo_hi_state[idx] = value
-            lo, hi = lo_hi_state
-            emit(
-                send,
-                THUMB_NEUTRAL_VAL
-                if lo == hi
-                else (THUMB_MIN_VAL if lo else THUMB_MAX_VAL),
-            )
 
-        return (
-            (lo_on, functools.partial(on_change, 0)),
-            (hi_on, functools.partial(on_change, 1)),
-        )
+# Layout of the kernel's `struct input_event`: a `struct timeval` (sec, usec)
+# followed by type, code and value. Events are read in batches of this many.
+INPUT_EVENT: Final = struct.Struct("llHHi")
+INPUT_EVENT_SIZE: Final = INPUT_EVENT.size
+INPUT_EVENT_BATCH: Final = 64
+
+# Values of EV_KEY input events. Autorepeat (2) is ignored.
+KEY_UP_VAL: Final = 0
+KEY_DOWN_VAL: Final = 1
+
+# Hold key releases back for RELEASE_DEBOUNCE_SECS and drop them together
+# with the following press if the key goes down again in the meantime, so
+# switch bounce doesn't reach the controller. Off by default, since keyboards
+# already debounce in firmware and this delays every release. That includes
+# changes of direction: the thumbpad stays neutral until the release of the
+# old direction key goes through.
+DEBOUNCE: Final = os.environ.get("CONTROLLER_DEBOUNCE") == "1"
+RELEASE_DEBOUNCE_SECS: Final = 0.005
+
+# SCHED_FIFO priority of the event loops, see `set_realtime`
+SCHED_PRIORITY: Final = 20
+
+# Flags for mlockall(2)
+MCL_CURRENT: Final = 1
+MCL_FUTURE: Final = 2
+
 
-    def key_to_button(*, on: InKey, send: OutEvent) -> InKeyListener:
-        def handler(pressed: bool) -> None:
-            emit(send, BTN_DOWN_VAL if pressed else BTN_UP_VAL)
-
-        return (on, handler)
-
-    return (
-        # Movement keys
-        *direction_keys_to_axis(
-            lo_on=ecodes.KEY_A,
-            hi_on=ecodes.KEY_D,
-            send=uinput.ABS_X,
-        ),
-        *direction_keys_to_axis(
-            lo_on=ecodes.KEY_W,
-            hi_on=ecodes.KEY_S,
-            send=uinput.ABS_Y,
-        ),
-        # Fire keys
-        key_to_button(on=ecodes.KEY_DOWN, send=uinput.BTN_A),
-        key_to_button(on=ecodes.KEY_RIGHT, send=uinput.BTN_B),
-        key_to_button(on=ecodes.KEY_LEFT, send=uinput.BTN_X),
-        key_to_button(on=ecodes.KEY_UP, send=uinput.BTN_Y),
-        # Use keys
-        key_to_button(on=ecodes.KEY_Q, send=uinput.BTN_TR),
-        key_to_button(on=ecodes.KEY_E, send=uinput.BTN_TL),
-        key_to_button(on=ecodes.KEY_SPACE, send=uinput.ABS_Z),
-        # Other action keys
-        key_to_button(on=ecodes.KEY_LEFTCTRL, send=uinput.ABS_RZ),
-        # Used to join multiplayer and interact with the map
-        key_to_button(on=ecodes.KEY_TAB, send=uinput.BTN_SELECT),
-        # Hold together with thumbr to reset run
-        key_to_button(on=ecodes.KEY_J, send=uinput.BTN_THUMBL),
-        # Emote
-        key_to_button(on=ecodes.KEY_K, send=uinput.BTN_THUMBR),
-        # Join game (local multiplayer)
-        key_to_button(on=ecodes.KEY_4, send=uinput.BTN_START),
+# Thumbpad axes driven by direction keys, referred to by index in bindings.
+THUMB_AXES: Final[tuple[OutEvent, ...]] = (uinput.ABS_X, uinput.ABS_Y)
+THUMB_X: Final = 0
+THUMB_Y: Final = 1
+
+
+def axis_value(lo: bool, hi: bool) -> OutEventValue:
+    return THUMB_NEUTRAL_VAL if lo == hi else (THUMB_MIN_VAL if lo else THUMB_MAX_VAL)
+
+
+# Values of all THUMB_AXES for every combination of held direction keys,
+# indexed by a mask with bit `2 * axis + is_hi` set while that key is held.
+THUMB_LUT: Final[tuple[tuple[OutEventValue, ...], ...]] = tuple(
+    tuple(
+        axis_value(bool(state >> 2 * axis & 1), bool(state >> 2 * axis + 1 & 1))
+        for axis in range(len(THUMB_AXES))
     )
+    for state in range(1 << 2 * len(THUMB_AXES))
+)
+
+# Bindings are plain tuples tagged by their first item, so the event loop
+# can act on them directly instead of calling a handler per key.
+# Press and release the event together with the key.
+BUTTON_BIND: Final = 0
+type ButtonBind = tuple[Literal[0], OutEvent]
+# Deflect an axis from THUMB_AXES towards its low or high end.
+AXIS_BIND: Final = 1
+type AxisBind = tuple[Literal[1], int, Literal[0, 1]]
+
+type InKeyBind = ButtonBind | AxisBind
+type InKeyListener = tuple[InKey, InKeyBind]
+type InKeyDispatch = tuple[tuple[InKeyBind, ...] | None, ...]
+
+BINDINGS: Final[tuple[InKeyListener, ...]] = (
+    # Movement keys
+    (ecodes.KEY_A, (AXIS_BIND, THUMB_X, 0)),
+    (ecodes.KEY_D, (AXIS_BIND, THUMB_X, 1)),
+    (ecodes.KEY_W, (AXIS_BIND, THUMB_Y, 0)),
+    (ecodes.KEY_S, (AXIS_BIND, THUMB_Y, 1)),
+    # Fire keys
+    (ecodes.KEY_DOWN, (BUTTON_BIND, uinput.BTN_A)),
+    (ecodes.KEY_RIGHT, (BUTTON_BIND, uinput.BTN_B)),
+    (ecodes.KEY_LEFT, (BUTTON_BIND, uinput.BTN_X)),
+    (ecodes.KEY_UP, (BUTTON_BIND, uinput.BTN_Y)),
+    # Use keys
+    (ecodes.KEY_Q, (BUTTON_BIND, uinput.BTN_TR)),
+    (ecodes.KEY_E, (BUTTON_BIND, uinput.BTN_TL)),
+    (ecodes.KEY_SPACE, (BUTTON_BIND, uinput.ABS_Z)),
+    # Other action keys
+    (ecodes.KEY_LEFTCTRL, (BUTTON_BIND, uinput.ABS_RZ)),
+    # Used to join multiplayer and interact with the map
+    (ecodes.KEY_TAB, (BUTTON_BIND, uinput.BTN_SELECT)),
+    # Hold together with thumbr to reset run
+    (ecodes.KEY_J, (BUTTON_BIND, uinput.BTN_THUMBL)),
+    # Emote
+    (ecodes.KEY_K, (BUTTON_BIND, uinput.BTN_THUMBR)),
+    # Join game (local multiplayer)
+    (ecodes.KEY_4, (BUTTON_BIND, uinput.BTN_START)),
+)
+
 
+def build_dispatch(bindings: Iterable[InKeyListener]) -> InKeyDispatch:
+    # Keycodes are small, so index a flat tuple instead of hashing into
+    # a dict for every event.
+    keymap: dict[InKey, list[InKeyBind]] = {}
+    for on, bind in bindings:
+        keymap.setdefault(on, []).append(bind)
 
-def create_device() -> uinput.Device:
+    dispatch: list[tuple[InKeyBind, ...] | None] = [None] * (max(keymap) + 1)
+    for on, key_binds in keymap.items():
+        dispatch[on] = tuple(key_binds)
+    return tuple(dispatch)
+
+
+# Bindings of each input key, indexed by keycode
+DISPATCH: Final = build_dispatch(BINDINGS)
+
+# Key state changes handed from the reader thread to the writer.
+# `None` signals that the reader has stopped.
+type KeyQueue = deque[tuple[InKey, bool] | None]
+
+
+# Terminates a batch of events written to the output device
+SYN_REPORT: Final[OutEvent] = (ecodes.EV_SYN, ecodes.SYN_REPORT)
+
+
+def emit(buf: bytearray, offset: int, event: OutEvent, value: OutEventValue) -> int:
+    # Events are packed into `buf` and written to the uinput fd together
+    # with a SYN_REPORT once every binding of the input key has been applied.
+    # The kernel fills in the timestamp. Returns the offset after the event.
+    if DEBUG:
+        print(f"{event=}, {value=}")
+    INPUT_EVENT.pack_into(buf, offset, 0, 0, *event, value)
+    return offset + INPUT_EVENT_SIZE
+
+
+def create_device(fd: int) -> uinput.Device:
     # uinput values for ABS events: (min, max, fuzz, flat).
     # shoulder triggers are treated as buttons.
     thumb_dat = (THUMB_MIN_VAL, THUMB_MAX_VAL, 0, 0)
@@ -134,17 +201,182 @@ def create_device() -> uinput.Device:
         product=0x028E,
         version=0x110,
         name="Microsoft X-Box 360 pad",
+        fd=fd,
     )
 
 
+def read_key_events(
+    fd: int, dispatch: InKeyDispatch, queue: KeyQueue, wakeup: int
+) -> None:
+    # Read raw `input_event` structs in batches instead of going through
+    # evdev's generator and `categorize`, which allocate per event.
+    # evdev opens the device non-blocking; switch it to blocking so each
+    # batch costs a single read() instead of a select() plus a read().
+    os.set_blocking(fd, True)
+
+    # Bind everything used per event to locals, which are cheaper to look up
+    # than globals and attributes.
+    EV_KEY = ecodes.EV_KEY
+    readv = os.readv
+    unpack_from = INPUT_EVENT.unpack_from
+    dispatch_len = len(dispatch)
+    push = queue.append
+
+    # Every batch is read into the same buffer
+    buf = bytearray(INPUT_EVENT_SIZE * INPUT_EVENT_BATCH)
+    bufs = [buf]
+    try:
+        while True:
+            size = readv(fd, bufs)
+            queued = False
+            for offset in range(0, size, INPUT_EVENT_SIZE):
+                _sec, _usec, type_, code, value = unpack_from(buf, offset)
+                if type_ != EV_KEY or code >= dispatch_len:
+                    continue
+
+                if dispatch[code] is None:
+                    continue
+
+                if value == KEY_DOWN_VAL:
+                    pressed = True
+                elif value == KEY_UP_VAL:
+                    pressed = False
+                else:
+                    continue
+
+                push((code, pressed))
+                queued = True
+
+            # Wake the writer once per batch rather than once per event, and
+            # not at all for batches of autorepeats or unbound keys.
+            if queued:
+                os.eventfd_write(wakeup, 1)
+    finally:
+        queue.append(None)
+        os.eventfd_write(wakeup, 1)
+
+
+def dispatch_key_events(
+    out_fd: int, dispatch: InKeyDispatch, queue: KeyQueue, wakeup: int
+) -> None:
+    # Output events of one key change, written with a single write().
+    # A key change emits at most one event per binding, plus SYN_REPORT.
+    max_binds = max(len(binds) for binds in dispatch if binds is not None)
+    out_buf = bytearray(INPUT_EVENT_SIZE * (max_binds + 1))
+    out_view = memoryview(out_buf)
+
+    # Held direction keys as a THUMB_LUT index, and the last value
+    # sent for each axis so unchanged axes aren't re-sent.
+    thumb_state = 0
+    thumb_sent = list(THUMB_LUT[thumb_state])
+
+    # Deadlines of held back key releases
+    pending_release: dict[InKey, float] = {}
+
+    # Locals for everything used per event, as in `read_key_events`
+    monotonic = time.monotonic
+    pop_key = queue.popleft
+    write = os.write
+
+    while True:
+        timeout = (
+            min(pending_release.values()) - monotonic() if pending_release else None
+        )
+        if timeout is None or timeout > 0:
+            ready, _, _ = select.select([wakeup], [], [], timeout)
+            if ready:
+                os.eventfd_read(wakeup)
+
+        now = monotonic()
+        changes: list[tuple[InKey, bool]] = []
+        for code, deadline in list(pending_release.items()):
+            if deadline <= now:
+                del pending_release[code]
+                changes.append((code, False))
+
+        while queue:
+            item = pop_key()
+            if item is None:
+                return
+
+            code, pressed = item
+            if pressed:
+                if pending_release.pop(code, None) is None:
+                    changes.append((code, True))
+            elif DEBOUNCE:
+                pending_release[code] = now + RELEASE_DEBOUNCE_SECS
+            else:
+                changes.append((code, False))
+
+        for code, pressed in changes:
+            binds = dispatch[code]
+            assert binds is not None
+            size = 0
+            for bind in binds:
+                if bind[0] == AXIS_BIND:
+                    _, axis, is_hi = bind
+                    bit = 1 << (2 * axis + is_hi)
+                    if pressed:
+                        thumb_state |= bit
+                    else:
+                        thumb_state &= ~bit
+
+                    value = THUMB_LUT[thumb_state][axis]
+                    if value == thumb_sent[axis]:
+                        continue
+                    thumb_sent[axis] = value
+                    size = emit(out_buf, size, THUMB_AXES[axis], value)
+                else:
+                    _, event = bind
+                    size = emit(
+                        out_buf,
+                        size,
+                        event,
+                        BTN_DOWN_VAL if pressed else BTN_UP_VAL,
+                    )
+
+            if size:
+                # Packed directly rather than through `emit`, so that
+                # CONTROLLER_DEBUG only prints actual controller events
+                INPUT_EVENT.pack_into(out_buf, size, 0, 0, *SYN_REPORT, 0)
+                size += INPUT_EVENT_SIZE
+                write(out_fd, out_view[:size])
+
+
+def set_realtime() -> None:
+    # Keeps latency spikes down by running with real-time priority, kept off
+    # CPU 0 (which handles most interrupts), with all pages locked in memory
+    # so page faults can't stall an event. Threads started afterwards inherit
+    # this. The affinity is the set of all other CPUs rather than a single
+    # one, so the reader and writer threads can run on separate CPUs and a
+    # slow uinput write doesn't hold up reading at the same FIFO priority.
+    # It is left alone if that would leave fewer than two CPUs.
+    # Needs root (or CAP_SYS_NICE and CAP_IPC_LOCK), which uinput requires
+    # anyway. Failures are reported but not fatal.
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(SCHED_PRIORITY))
+    except OSError as e:
+        print(f"Could not enable real-time scheduling: {e}")
+
+    # With fewer than two CPUs left, both threads would share one again
+    cpus = os.sched_getaffinity(0) - {0}
+    if len(cpus) >= 2:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError as e:
+            print(f"Could not keep off CPU 0: {e}")
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        print(f"Could not lock memory: {os.strerror(ctypes.get_errno())}")
+
+
 def main() -> None:
     devices = [evdev.InputDevice(path) for path in evdev.list_devices()]
 
-    with create_device() as out_device:
-        keymap: dict[InKey, list[InKeyAction]] = {}
-        for on, action in build_keybinds(out_device):
-            keymap.setdefault(on, []).append(action)
-
+    # Keep hold of the raw uinput fd so events can be written to it directly
+    out_fd = uinput.fdopen()
+    with create_device(out_fd):
         if not devices:
             print("No input devices found. Run as root?")
             return
@@ -166,26 +398,53 @@ def main() -> None:
             except Exception:
                 pass
 
-        for event in device.read_loop():
-            if event.type != evdev.ecodes.EV_KEY:
-                continue
+        # Only the picked device is read from, don't keep the others open
+        for other in devices:
+            if other is not device:
+                other.close()
 
-            key_event = evdev.categorize(event)
-            if key_event.keystate == KeyEvent.key_down:
-                pressed = True
-            elif key_event.keystate == KeyEvent.key_up:
-                pressed = False
-            else:
-                continue
+        set_realtime()
+
+        if GRAB:
+            # Keys still held when grabbing (like the Enter that confirmed the
+            # device choice) would never have their release reach the rest of
+            # the system, leaving them stuck down there.
+            while device.active_keys():
+                time.sleep(0.01)
+            device.grab()
+        try:
+            # Reading happens on its own thread so that slow uinput writes
+            # don't delay picking up the next input event.
+            queue: KeyQueue = deque()
+            wakeup = os.eventfd(0)
+            reader = threading.Thread(
+                target=read_key_events,
+                args=(device.fd, DISPATCH, queue, wakeup),
+                daemon=True,
+            )
+            reader.start()
 
-            for act in keymap.get(event.code, ()):
-                act(pressed)
+            dispatch_key_events(out_fd, DISPATCH, queue, wakeup)
+        finally:
+            # Closing the device also releases the grab, so it doesn't
+            # outlive the process even if this is skipped (e.g. on SIGTERM)
+            # or fails because the device is gone, in which case the error
+            # that ended the event loop is the one worth seeing.
+            if GRAB:
+                try:
+                    device.ungrab()
+                except OSError:
+                    pass
 
 
-if __name__ == "__main__":
+def run() -> None:
     try:
         main()
     except KeyboardInterrupt:
         import sys
 
         sys.exit(130)
+
+
+if __name__ == "__main__":
+    run()